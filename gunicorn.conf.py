@@ -0,0 +1,17 @@
+# Gunicorn settings, picked up by the Procfile ('gunicorn -c gunicorn.conf.py main:app')
+import os
+
+# The blog mostly waits on the db, so a few threads per worker let requests overlap that waiting
+worker_class = "gthread"
+threads = 5
+# Heroku sets WEB_CONCURRENCY based on the dyno size
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+# Load the app once before forking so workers share its memory and start faster
+preload_app = True
+timeout = 60
+
+
+def post_fork(server, worker):
+    # With preload_app the db engine is created before forking - give each worker its own connections
+    from main import db
+    db.engine.dispose()
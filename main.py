@@ -1,41 +1,106 @@
 # gunicorn added as a package, with the Procfile telling Heroku to use gunicorn and main.py to deploy app
 import os
+import hashlib
 
 from flask import Flask, render_template, redirect, url_for, flash, abort
+from flask.helpers import get_debug_flag
 from flask_bootstrap import Bootstrap
 from flask_ckeditor import CKEditor
 from datetime import date
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHash
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import relationship
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.orm import relationship, joinedload, selectinload, load_only, validates
 from flask_login import UserMixin, login_user, LoginManager, login_required, current_user, logout_user
 from forms import CreatePostForm, RegisterForm, LoginForm, CommentForm
-from flask_gravatar import Gravatar
-from functools import wraps
+from flask_caching import Cache
+from flask_compress import Compress
+from functools import wraps, lru_cache
+
+# Bound once here rather than looking up date.today on every new post
+today = date.today
+
+
+##APP CONFIG
+# Everything comes from env variables - for Heroku these are found in the app's 'Settings' page
+class Config:
+    # Required - the app won't start without it
+    SECRET_KEY = os.environ["SECRET_KEY"]
+
+    # This has been adapted to use Heroku db first, and local database second if not available
+    SQLALCHEMY_DATABASE_URI = os.environ.get("DATABASE_URL", "sqlite:///blog.db")
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # pre_ping drops dead connections before use
+    SQLALCHEMY_ENGINE_OPTIONS = {"pool_pre_ping": True, "pool_size": 10}
+    if SQLALCHEMY_DATABASE_URI.startswith("sqlite"):
+        # SQLAlchemy otherwise opens a new connection per request for sqlite files (NullPool), losing the pragmas and
+        # page cache set below - keep them open instead, shared between the gthread threads
+        SQLALCHEMY_ENGINE_OPTIONS["poolclass"] = QueuePool
+        SQLALCHEMY_ENGINE_OPTIONS["connect_args"] = {"check_same_thread": False}
+
+    # SimpleCache is per gunicorn worker - set CACHE_TYPE=RedisCache and CACHE_REDIS_URL to share it between workers
+    CACHE_TYPE = os.environ.get("CACHE_TYPE", "SimpleCache")
+    CACHE_REDIS_URL = os.environ.get("CACHE_REDIS_URL", os.environ.get("REDIS_URL"))
+    CACHE_DEFAULT_TIMEOUT = 60
+
+    # gzip/brotli compress text responses big enough to be worth it
+    COMPRESS_MIMETYPES = ['text/html', 'text/css', 'application/json', 'application/javascript']
+    COMPRESS_LEVEL = 6
+    COMPRESS_MIN_SIZE = 500
+
+    # Templates are only checked on disk for changes in debug mode (FLASK_DEBUG=1), not on every render
+    TEMPLATES_AUTO_RELOAD = get_debug_flag()
+    JSONIFY_PRETTYPRINT_REGULAR = False
+
 
 app = Flask(__name__)
-# For a real program, the below key would be best places in an .env file
-# For Heruko, env variables are found in the app's 'Settings' page
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
+app.config.from_object(Config)
 ckeditor = CKEditor(app)
 Bootstrap(app)
+Compress(app)
 
 ## Implement Gravatar (default avatar generator)
-gravatar = Gravatar(app,
-                    size=100,
-                    rating='g',
-                    default='retro',
-                    force_default=False,
-                    force_lower=False,
-                    use_ssl=False,
-                    base_url=None)
+# Returns the md5 hash Gravatar uses to identify an email address.
+# Hashes are cached so a user with many comments on a page is only hashed once
+@lru_cache(maxsize=4096)
+def gravatar_hash(email):
+    return hashlib.md5(email.strip().lower().encode()).hexdigest()
+
+## Password hashing
+# argon2id is memory-hard, so offline GPU cracking of leaked hashes is far slower than with pbkdf2
+# Each hash/verify holds memory_cost KiB, and every gunicorn thread (workers x threads) may be logging someone in at once.
+# The defaults (19 MiB, 2 passes, 1 lane) keep 10 concurrent logins under ~200 MB, fitting a 512 MB Heroku dyno.
+# Raise them on bigger dynos - existing hashes are upgraded on the user's next login (see check_password)
+password_hasher = PasswordHasher(
+    time_cost=int(os.environ.get("ARGON2_TIME_COST", 2)),
+    memory_cost=int(os.environ.get("ARGON2_MEMORY_COST", 19 * 1024)),
+    parallelism=int(os.environ.get("ARGON2_PARALLELISM", 1))
+)
+
+## Page cache
+cache = Cache(app)
 
 ##CONNECT TO DB
-# This has been adapted to use Heroku db first, and local database second if not available
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get("DATABASE_URL",  "sqlite:///blog.db")
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 db = SQLAlchemy(app)
 
+
+if db.engine.dialect.name == "sqlite":
+    # These pragmas only last for the connection they're run on, so they're set on each new pooled connection
+    @event.listens_for(db.engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA cache_size=-20000")  # 20 MB
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
+    # WAL mode lets readers (other gunicorn threads/workers) carry on while a write is happening.
+    # It's saved in the db file itself, so it only needs setting once
+    db.engine.execute("PRAGMA journal_mode=WAL")
+
 ##LOGIN MANAGER
 # A login manager is required to use functions such as login_user
 login_manager = LoginManager()
@@ -50,11 +115,17 @@ def user_loader(user_id):  # I tried email but user id is better used
 
 ##CONFIGURE TABLES
 
+# Emails are stored lowercase so lookups can match them exactly against the unique index.
+# register/login normalise before querying; User's validator below is the safety net for any other write
+def normalize_email(email):
+    return email.strip().lower()
+
+
 class User(UserMixin, db.Model):
     __tablename__ = "users"
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(100), unique=True)
-    password = db.Column(db.String(100))
+    password = db.Column(db.String(255))
     name = db.Column(db.String(100))
 
     # This will act like a List of BlogPost objects 'attached' to each User.
@@ -64,6 +135,16 @@ class User(UserMixin, db.Model):
     # Same for comments
     comments = relationship("Comment", back_populates="comment_author")
 
+    # Safety net - any email set on a User is normalised, even if the caller forgot to
+    @validates("email")
+    def validate_email(self, key, email):
+        return normalize_email(email)
+
+    # Avatar image URL for this user (retro default image, 100px, rated 'g')
+    @property
+    def gravatar_url(self):
+        return f"https://www.gravatar.com/avatar/{gravatar_hash(self.email)}?s=100&d=retro&r=g"
+
 
 class BlogPost(db.Model):
     __tablename__ = "blog_posts"
@@ -72,13 +153,15 @@ class BlogPost(db.Model):
     # Creates Foreign Key - copies a Primary Key from a 'foreign' table to link entries between the two
     #  "users.id" the users refers to the tablename of User.
     # author_id IS stored in the .db file - it is a real attribute that is populated with data (id) from the users table
-    author_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+    # index=True lets lookups by author use an index instead of scanning the table
+    author_id = db.Column(db.Integer, db.ForeignKey("users.id"), index=True)
     # Create reference to the User object, the "posts" refers to the posts property in the User class.
     author = relationship("User", back_populates="posts")
 
     title = db.Column(db.String(250), unique=True, nullable=False)
     subtitle = db.Column(db.String(250), nullable=False)
-    date = db.Column(db.String(250), nullable=False)
+    # Stored as a real date so it sorts chronologically - formatted for display by the 'longdate' template filter
+    date = db.Column(db.Date, nullable=False, index=True)
     body = db.Column(db.Text, nullable=False)
     img_url = db.Column(db.String(250), nullable=False)
     comments = relationship("Comment", back_populates="parent_post")
@@ -90,10 +173,10 @@ class Comment(db.Model):
     text = db.Column(db.Text, nullable=False)
 
     # Copied+edited from BlogPost to assign comment authors
-    author_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+    author_id = db.Column(db.Integer, db.ForeignKey("users.id"), index=True)
     comment_author = relationship("User", back_populates="comments")
     # Similar for parent blog posts
-    post_id = db.Column(db.Integer, db.ForeignKey("blog_posts.id"))
+    post_id = db.Column(db.Integer, db.ForeignKey("blog_posts.id"), index=True)
     parent_post = relationship("BlogPost", back_populates="comments")
 
 
@@ -101,14 +184,55 @@ class Comment(db.Model):
 db.create_all()
 
 
+# Inserts many new rows (e.g. when importing posts/comments) in a single transaction and commit
+def bulk_create(objects):
+    # Note: bulk saves skip relationship handling, so set foreign keys directly (author_id=..., not author=...)
+    db.session.bulk_save_objects(objects)
+    db.session.commit()
+
+
+# Checks a password against the user's stored hash, upgrading old pbkdf2 hashes to argon2 on success
+def check_password(user, password):
+    # Accounts registered before the switch to argon2 still have werkzeug pbkdf2 hashes
+    if user.password.startswith("pbkdf2:"):
+        if not check_password_hash(user.password, password):
+            return False
+        user.password = password_hasher.hash(password)
+        db.session.commit()
+        return True
+
+    try:
+        password_hasher.verify(user.password, password)
+    except (VerificationError, InvalidHash):
+        return False
+    # Re-hash if the cost parameters above have been raised since this hash was made
+    if password_hasher.check_needs_rehash(user.password):
+        user.password = password_hasher.hash(password)
+        db.session.commit()
+    return True
+
+
+# Makes 'logged_in' available to every template (used by header.html for the nav links)
+@app.context_processor
+def inject_logged_in():
+    return {"logged_in": current_user.is_authenticated}
+
+
+# Formats a date for display in templates, e.g. {{ post.date|longdate }} -> 'May 21, 2022'
+@app.template_filter('longdate')
+def longdate(post_date):
+    return post_date.strftime("%B %d, %Y")
+
+
 # Admin-only decorator function
 def admin_only(page_function):
     # functools.wraps() required to create these login decorator functions
+    # *args/**kwargs pass through any URL variables (e.g. post_id) Flask gives the page
     @wraps(page_function)
-    def check_admin():
+    def check_admin(*args, **kwargs):
         if current_user.is_authenticated and current_user.id == 1:
             # Return the page under the decorator if the user is the admin (id 1)
-            return page_function()
+            return page_function(*args, **kwargs)
         else:
             # flask.abort function useful for rendering basic error pages
             return abort(403)
@@ -117,29 +241,34 @@ def admin_only(page_function):
 
 
 @app.route('/')
+# Only logged out visitors get the cached page, since logged in users (the admin) see extra buttons
+@cache.cached(key_prefix="all_posts", unless=lambda: current_user.is_authenticated)
 def get_all_posts():
-    posts = BlogPost.query.all()
-    return render_template("index.html", all_posts=posts, logged_in=current_user.is_authenticated)
+    # joinedload pulls each post's author in the same query (one JOIN) instead of one SELECT per post
+    # load_only skips the (potentially large) post body, which the index page doesn't show
+    posts = BlogPost.query.options(
+        load_only(BlogPost.title, BlogPost.subtitle, BlogPost.date, BlogPost.img_url),
+        joinedload(BlogPost.author).load_only(User.name)
+    ).all()
+    return render_template("index.html", all_posts=posts)
 
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     form = RegisterForm()
     if form.validate_on_submit():
+        email = normalize_email(form.email.data)
 
         # Check if email already in db, redirect to login if so
-        if User.query.filter_by(email=form.email.data).first():
+        # Only the id is fetched - no need to build a whole User object just to check it exists
+        if db.session.query(User.id).filter_by(email=email).first() is not None:
             flash("Already registered with that email - Please log in instead.")
             return redirect(url_for('login'))
 
-        hash_and_salted_password = generate_password_hash(
-            form.password.data,
-            method='pbkdf2:sha256',
-            salt_length=8
-        )
+        hash_and_salted_password = password_hasher.hash(form.password.data)
 
         new_user = User(
-            email=form.email.data,
+            email=email,
             password=hash_and_salted_password,
             name=form.name.data
         )
@@ -157,14 +286,15 @@ def login():
     form = LoginForm()
     if form.validate_on_submit():
         # Find user by email entered.
-        user = User.query.filter_by(email=form.email.data).first()
+        user = User.query.filter_by(email=normalize_email(form.email.data)).first()
 
         # Email doesn't exist - redirects to login page (this page) w/flash message
         if not user:
             flash("That email does not exist, please try again.")
             return redirect(url_for('login'))
         # Password incorrect - redirects to login page (this page) w/flash message
-        elif not check_password_hash(user.password, form.password.data):
+        # Password hashes are compared in constant time - any other secret/token check should use hmac.compare_digest, not ==
+        elif not check_password(user, form.password.data):
             flash('Password incorrect, please try again.')
             return redirect(url_for('login'))
         # Email exists and password correct
@@ -185,7 +315,12 @@ def show_post(post_id):
     # Comments are treated like a property of the blog post, like a list under an object
     # Therefore can be accessed (in Jinja/HTML?) with post.comments
     # since 'comments' is a property of the 'BlogPost' table
-    requested_post = BlogPost.query.get(post_id)
+    # The comments and their authors are loaded up front in one query each (selectinload uses 'WHERE id IN (...)'),
+    # so a user who commented many times is only fetched once rather than once per comment row
+    requested_post = BlogPost.query.options(
+        joinedload(BlogPost.author),
+        selectinload(BlogPost.comments).selectinload(Comment.comment_author)
+    ).get_or_404(post_id)
     form = CommentForm()
     if form.validate_on_submit():
         if not current_user.is_authenticated:
@@ -202,17 +337,17 @@ def show_post(post_id):
         db.session.commit()
         return redirect(url_for('show_post', post_id=post_id))
 
-    return render_template("post.html", post=requested_post, logged_in=current_user.is_authenticated, form=form)
+    return render_template("post.html", post=requested_post, form=form)
 
 
 @app.route("/about")
 def about():
-    return render_template("about.html", logged_in=current_user.is_authenticated)
+    return render_template("about.html")
 
 
 @app.route("/contact")
 def contact():
-    return render_template("contact.html", logged_in=current_user.is_authenticated)
+    return render_template("contact.html")
 
 
 @app.route("/new-post", methods=['GET', 'POST'])
@@ -226,18 +361,19 @@ def add_new_post():
             body=form.body.data,
             img_url=form.img_url.data,
             author=current_user,
-            date=date.today().strftime("%B %d, %Y")
+            date=today()
         )
         db.session.add(new_post)
         db.session.commit()
+        cache.delete("all_posts")
         return redirect(url_for("get_all_posts"))
-    return render_template("make-post.html", form=form, logged_in=current_user.is_authenticated)
+    return render_template("make-post.html", form=form)
 
 
 @app.route("/edit-post/<int:post_id>")
 @admin_only
 def edit_post(post_id):
-    post = BlogPost.query.get(post_id)
+    post = BlogPost.query.get_or_404(post_id)
     edit_form = CreatePostForm(
         title=post.title,
         subtitle=post.subtitle,
@@ -252,19 +388,22 @@ def edit_post(post_id):
         post.author = edit_form.author.data
         post.body = edit_form.body.data
         db.session.commit()
+        cache.delete("all_posts")
         return redirect(url_for("show_post", post_id=post.id))
 
-    return render_template("make-post.html", form=edit_form, logged_in=current_user.is_authenticated)
+    return render_template("make-post.html", form=edit_form)
 
 
 @app.route("/delete/<int:post_id>")
 @admin_only
 def delete_post(post_id):
-    post_to_delete = BlogPost.query.get(post_id)
+    post_to_delete = BlogPost.query.get_or_404(post_id)
     db.session.delete(post_to_delete)
     db.session.commit()
+    cache.delete("all_posts")
     return redirect(url_for('get_all_posts'))
 
 
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # Local development only - Heroku runs the app through gunicorn (see Procfile)
+    app.run(host='0.0.0.0', port=5000, debug=get_debug_flag())
@@ -0,0 +1,68 @@
+# One-off migrations for databases created before the matching model changes in main.py
+# db.create_all() only creates missing tables - it never changes columns/indexes on tables that already exist.
+# Run once per database, with the same DATABASE_URL as the app (on Heroku: heroku run python migrate.py)
+# Every step checks what's already there, so running it again is harmless
+import os
+from datetime import datetime
+
+from sqlalchemy import create_engine, inspect, text
+
+engine = create_engine(os.environ.get("DATABASE_URL", "sqlite:///blog.db"))
+
+
+def create_index(connection, name, table, column):
+    # Skips indexes that already exist (e.g. made by create_all on a fresh db)
+    if name not in [index["name"] for index in inspect(connection).get_indexes(table)]:
+        connection.execute(text(f"CREATE INDEX {name} ON {table} ({column})"))
+
+
+def add_foreign_key_indexes(connection):
+    # Foreign key columns were given index=True so posts/comments can be looked up by author or post without a scan
+    create_index(connection, "ix_blog_posts_author_id", "blog_posts", "author_id")
+    create_index(connection, "ix_comments_author_id", "comments", "author_id")
+    create_index(connection, "ix_comments_post_id", "comments", "post_id")
+
+
+def normalize_emails(connection):
+    # Emails are now stored and looked up lowercase - older rows need the same treatment or those users can't log in
+    duplicates = connection.execute(text(
+        "SELECT lower(trim(email)) FROM users GROUP BY lower(trim(email)) HAVING count(*) > 1"
+    )).fetchall()
+    if duplicates:
+        # Two accounts differing only by case - an admin has to decide which one to keep
+        raise SystemExit("Merge/remove these duplicate accounts first: " + ", ".join(row[0] for row in duplicates))
+    connection.execute(text("UPDATE users SET email = lower(trim(email)) WHERE email != lower(trim(email))"))
+
+
+def migrate_post_dates(connection):
+    # BlogPost.date went from 'May 21, 2022' strings (VARCHAR) to a real DATE column
+    if connection.dialect.name == "postgresql":
+        column_type = connection.execute(text(
+            "SELECT data_type FROM information_schema.columns "
+            "WHERE table_name = 'blog_posts' AND column_name = 'date'"
+        )).scalar()
+        if column_type != "date":
+            connection.execute(text(
+                "ALTER TABLE blog_posts ALTER COLUMN date TYPE date USING to_date(date, 'FMMonth DD, YYYY')"
+            ))
+    else:
+        # SQLite has no real DATE type - SQLAlchemy stores dates as 'YYYY-MM-DD' text, so only the values change
+        for post_id, post_date in connection.execute(text("SELECT id, date FROM blog_posts")).fetchall():
+            try:
+                new_date = datetime.strptime(post_date, "%B %d, %Y").date()
+            except ValueError:
+                continue  # Already converted
+            connection.execute(
+                text("UPDATE blog_posts SET date = :date WHERE id = :id"),
+                date=new_date.isoformat(), id=post_id
+            )
+    create_index(connection, "ix_blog_posts_date", "blog_posts", "date")
+
+
+if __name__ == "__main__":
+    # One transaction, so a failed step leaves the db as it was
+    with engine.begin() as connection:
+        add_foreign_key_indexes(connection)
+        migrate_post_dates(connection)
+        normalize_emails(connection)
+    print("Migrations complete.")